@@ -26,10 +26,11 @@ def detect_bias_component(
 ):
     import os
     import requests
+    import numpy as np
     import pandas as pd
     import tensorflow as tf
     from datetime import datetime
-    from transformers import TFAutoModelForSequenceClassification
+    from transformers import AutoConfig, TFAutoModelForSequenceClassification
     from fairlearn.metrics import MetricFrame, true_positive_rate, false_positive_rate, selection_rate
     
     # Hardcoded label map
@@ -89,13 +90,14 @@ def detect_bias_component(
             print(e)
 
     # Load and parse test dataset
-    def parse_tfrecord_fn(example_proto, max_sequence_length=max_sequence_length):
+    def parse_tfrecord_fn(example_protos, max_sequence_length=max_sequence_length):
       feature_description = {
-          'feature': tf.io.FixedLenFeature([max_sequence_length], tf.int64),
+          'feature': tf.io.FixedLenFeature([], tf.string),
           'label': tf.io.FixedLenFeature([], tf.int64),
       }
-      parsed_example = tf.io.parse_single_example(example_proto, feature_description)
-      return parsed_example['feature'], parsed_example['label']
+      parsed_examples = tf.io.parse_example(example_protos, feature_description)
+      features = tf.reshape(tf.io.decode_raw(parsed_examples['feature'], tf.int32), [tf.shape(example_protos)[0], max_sequence_length])
+      return features, parsed_examples['label']
 
 
     try:
@@ -112,21 +114,31 @@ def detect_bias_component(
 
 
         record_path = os.path.join(test_data.path, f'{test_data_name}.tfrecord')
-        test_dataset = tf.data.TFRecordDataset(record_path)
-        test_dataset = test_dataset.map(parse_tfrecord_fn).batch(batch_size)
+        test_dataset = tf.data.TFRecordDataset(record_path, num_parallel_reads=tf.data.AUTOTUNE)
+        test_dataset = test_dataset.batch(batch_size)
+        test_dataset = test_dataset.map(parse_tfrecord_fn, num_parallel_calls=tf.data.AUTOTUNE)
+        test_dataset = test_dataset.prefetch(tf.data.AUTOTUNE)
 
         model_path = os.path.join(model.path, f'{model_save_name}.keras')
-        loaded_model = TFAutoModelForSequenceClassification.from_pretrained(
-            huggingface_model_name,
-            num_labels=len(label_map)
-        )
+        # Load model from the trained model path
+        config = AutoConfig.from_pretrained(huggingface_model_name, num_labels=len(label_map))
+        loaded_model = TFAutoModelForSequenceClassification.from_config(config)
+        loaded_model.build_in_name_scope()
         loaded_model.load_weights(model_path)
 
-        predictions = loaded_model.predict(test_dataset)
-        logits = predictions.logits
+        @tf.function
+        def predict_step(features):
+            logits = loaded_model(features, training=False).logits
+            return tf.argmax(logits, axis=1, output_type=tf.int32)
+
+        # Collect predictions and labels in a single pass over the test dataset
+        y_true_batches, y_pred_batches = [], []
+        for features, labels in test_dataset:
+            y_pred_batches.append(predict_step(features).numpy())
+            y_true_batches.append(labels.numpy())
 
-        y_true = [label for _, label in list(test_dataset.unbatch().as_numpy_iterator())]
-        y_pred = list(tf.argmax(logits, axis=1).numpy())
+        y_true = np.concatenate(y_true_batches)
+        y_pred = np.concatenate(y_pred_batches)
 
         df = pd.DataFrame({
             'true_label': y_true,
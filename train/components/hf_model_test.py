@@ -2,7 +2,7 @@ from typing import Dict, NamedTuple
 from kfp.dsl import component, Input, Output, Dataset, Model, Metrics, Artifact
 
 @component(
-    base_image="tensorflow/tensorflow:2.14.0",
+    base_image="tensorflow/tensorflow:2.14.0-gpu",
     packages_to_install = [
         'pandas==1.5.3',
         'numpy==1.26.4',
@@ -10,6 +10,9 @@ from kfp.dsl import component, Input, Output, Dataset, Model, Metrics, Artifact
         'scikit-learn==1.5.2',
         'keras==2.14.0',
         'google-cloud-aiplatform==1.18.3',
+        'tf2onnx==1.16.1',
+        'onnx==1.14.1',
+        'onnxruntime==1.16.3',
         'protobuf==3.20.*'
     ]
 )
@@ -25,9 +28,10 @@ def test_huggingface_model_component(
     label_name: str,
     label_map: Dict[str, int],
     model_save_name: str = 'saved_tf_hf_model',
-    batch_size: int = 8,
+    batch_size: int = 64,
     max_sequence_length: int = 128,
     huggingface_model_name: str = 'bert-base-multilingual-cased',
+    inference_backend: str = 'keras',
     slack_url: str = None,
 ) -> NamedTuple('Outputs', [
     ('precision', float),
@@ -38,13 +42,24 @@ def test_huggingface_model_component(
     import re
     import json
     import time
+    import tempfile
+    import threading
     import requests
     from datetime import datetime
-    import tensorflow as tf
     from collections import namedtuple
-    import google.cloud.aiplatform as aiplatform
-    from transformers import TFAutoModelForSequenceClassification
-    from sklearn.metrics import precision_score, recall_score, f1_score, confusion_matrix
+
+    slack_threads = []
+
+    def post_slack_message(webhook_url: str, message: dict):
+        try:
+            requests.post(webhook_url, json=message, timeout=2)
+        except requests.exceptions.RequestException as e:
+            print(e)
+
+    def wait_for_slack_messages(timeout: float = 2):
+        # Give in-flight notifications a bounded chance to finish before the container exits
+        for thread in slack_threads:
+            thread.join(timeout=timeout)
 
     def send_slack_message(
         webhook_url: str,
@@ -93,18 +108,20 @@ def test_huggingface_model_component(
             ]
         }
 
-        try:
-            response = requests.post(webhook_url, json=message)
-            response.raise_for_status()
-        except requests.exceptions.RequestException as e:
-            print(e)
+        # Post from a daemon thread so a slow Slack webhook does not hold up the evaluation
+        thread = threading.Thread(target=post_slack_message, args=(webhook_url, message), daemon=True)
+        thread.start()
+        slack_threads.append(thread)
+
+    invalid_experiment_chars = re.compile(r'[^a-z0-9-]')
+    experiment_name_start = re.compile(r'^[a-z0-9]')
 
     def build_experiment_name(experiment_name: str) -> str:
         name = experiment_name.lower()
         # Replace invalid characters with hyphens
-        name = re.sub(r'[^a-z0-9-]', '-', name)
+        name = invalid_experiment_chars.sub('-', name)
         # Ensure the name starts with a lowercase letter or digit
-        if not re.match(r'^[a-z0-9]', name):
+        if not experiment_name_start.match(name):
             name = 'a' + name
         # Truncate to 128 characters
         name = name[:128]
@@ -114,67 +131,219 @@ def test_huggingface_model_component(
     
     start_time = datetime.now()
 
-    experiment_name = build_experiment_name(experiment_name=f'exp-{label_name}-{huggingface_model_name}')
-    aiplatform.init(project=project_id, location=location, experiment=experiment_name)
-    experiment_run_id = "run-{}".format(int(time.time()))
+    # Notify before the ML imports below, they take several seconds on a cold container
+    if slack_url:
+       send_slack_message(
+          webhook_url=slack_url, message_str=f'KubeFlow Component: Test HuggingFace Model | Model: {huggingface_model_name} started', 
+          execution_date=start_time.date(), execution_time=start_time.time(), 
+          duration=0, is_success=True
+          )
 
-    aiplatform.start_run(experiment_run_id)
+    try:
 
-    idx_2_label_map = {v:k for k,v in label_map.items()}
+      if inference_backend not in ('keras', 'onnx_int8', 'saved_model'):
+         raise ValueError(f'Unsupported inference backend: {inference_backend}')
 
-    def parse_tfrecord_fn(example_proto, max_sequence_length=max_sequence_length):
-      feature_description = {
-          'feature': tf.io.FixedLenFeature([max_sequence_length], tf.int64),
-          'label': tf.io.FixedLenFeature([], tf.int64),
-      }
-      parsed_example = tf.io.parse_single_example(example_proto, feature_description)
-      return parsed_example['feature'], parsed_example['label']
+      import numpy as np
+      import tensorflow as tf
+      import google.cloud.aiplatform as aiplatform
+      from transformers import AutoConfig, TFAutoModelForSequenceClassification
+      from sklearn.metrics import precision_recall_fscore_support
 
-    try:
-      
-      if slack_url:
-         send_slack_message(
-            webhook_url=slack_url, message_str=f'KubeFlow Component: Test HuggingFace Model | Model: {huggingface_model_name} started', 
-            execution_date=start_time.date(), execution_time=start_time.time(), 
-            duration=0, is_success=True
-            )
+      experiment_name = build_experiment_name(experiment_name=f'exp-{label_name}-{huggingface_model_name}')
+      aiplatform.init(project=project_id, location=location, experiment=experiment_name)
+      experiment_run_id = "run-{}".format(int(time.time()))
+
+      aiplatform.start_run(experiment_run_id)
+
+      idx_2_label_map = {v:k for k,v in label_map.items()}
+
+      def parse_tfrecord_fn(example_protos, max_sequence_length=max_sequence_length):
+         # Parse the whole batch at once
+         feature_description = {
+             'feature': tf.io.FixedLenFeature([], tf.string),
+             'label': tf.io.FixedLenFeature([], tf.int64),
+         }
+         parsed_examples = tf.io.parse_example(example_protos, feature_description)
+         features = tf.reshape(tf.io.decode_raw(parsed_examples['feature'], tf.int32), [tf.shape(example_protos)[0], max_sequence_length])
+         return features, parsed_examples['label']
 
       # Load test dataset
       record_path = os.path.join(test_data.path, f'{test_data_name}.tfrecord')
-      test_dataset = tf.data.TFRecordDataset(record_path)
-      test_dataset = test_dataset.map(parse_tfrecord_fn).batch(batch_size)
+      test_records = tf.data.TFRecordDataset(record_path, num_parallel_reads=tf.data.AUTOTUNE)
+      # The holdout split fits in memory, the counting pass below fills the cache so the file is read once
+      test_records = test_records.cache()
+      num_examples = int(test_records.reduce(0, lambda count, _: count + 1).numpy())
+
+      def build_test_dataset(batch_size):
+         test_dataset = test_records.batch(batch_size)
+         test_dataset = test_dataset.map(parse_tfrecord_fn, num_parallel_calls=tf.data.AUTOTUNE)
+         return test_dataset.prefetch(tf.data.AUTOTUNE)
+
+      # Run the encoder in reduced precision on GPU, bfloat16 on Ampere (compute capability 8.0) and newer
+      gpus = tf.config.list_physical_devices('GPU')
+      if gpus and inference_backend == 'keras':
+         compute_capability = tf.config.experimental.get_device_details(gpus[0]).get('compute_capability', (0, 0))
+         precision_policy = 'mixed_bfloat16' if compute_capability >= (8, 0) else 'mixed_float16'
+      else:
+         precision_policy = 'float32'
+      tf.keras.mixed_precision.set_global_policy(precision_policy)
 
-      # Load model from the trained model path
       model_path = os.path.join(model.path, f'{model_save_name}.keras')
-      loaded_model = TFAutoModelForSequenceClassification.from_pretrained(
-          huggingface_model_name,
-          num_labels=len(label_map)
-      )
-      loaded_model.load_weights(model_path)
 
-      # Get predictions
-      predictions = loaded_model.predict(test_dataset)
-      logits = predictions.logits
+      def load_model():
+         # Load model from the trained model path
+         config = AutoConfig.from_pretrained(huggingface_model_name, num_labels=len(label_map))
+         loaded_model = TFAutoModelForSequenceClassification.from_config(config)
+         loaded_model.build_in_name_scope()
+         loaded_model.load_weights(model_path)
+         return loaded_model
 
-      # Calculate metrics
-      y_true = [label for _, label in list(test_dataset.unbatch().as_numpy_iterator())]
-      y_pred = list(tf.argmax(logits, axis=1).numpy())
+      def find_inference_batch_size(predict_step, batch_size, max_batch_size):
+         # Halve until the compiled step fits in accelerator memory, then double while it still fits
+         def fits(size):
+            try:
+               predict_step(tf.zeros([size, max_sequence_length], dtype=tf.int32))
+               return True
+            except tf.errors.ResourceExhaustedError:
+               return False
 
-      y_true_decoded = [idx_2_label_map.get(i) for i in y_true]
-      y_pred_decoded = [idx_2_label_map.get(i) for i in y_pred]
+         batch_size = max(min(batch_size, max_batch_size), 1)
+         while batch_size > 1 and not fits(batch_size):
+            batch_size //= 2
+         while batch_size * 2 <= max_batch_size and fits(batch_size * 2):
+            batch_size *= 2
+         return batch_size
+
+      @tf.function
+      def update_confusion_matrix(confusion, labels, predictions):
+         return confusion + tf.math.confusion_matrix(labels, predictions, num_classes=len(label_map), dtype=tf.int64)
+
+      def collect_predictions(predict_batch):
+         # Fill preallocated buffers with predictions and labels in a single pass over the test dataset,
+         # the confusion matrix is accumulated on device alongside
+         y_true = np.empty(num_examples, dtype=np.int32)
+         y_pred = np.empty(num_examples, dtype=np.int32)
+         confusion = tf.zeros([len(label_map), len(label_map)], dtype=tf.int64)
+         offset = 0
+         for features, labels in test_dataset:
+            batch_length = len(labels)
+            predictions = predict_batch(features)
+            confusion = update_confusion_matrix(confusion, labels, predictions)
+            y_pred[offset:offset + batch_length] = np.asarray(predictions)
+            y_true[offset:offset + batch_length] = labels.numpy()
+            offset += batch_length
+         return y_true, y_pred, confusion.numpy()
+
+      def build_predict_step(loaded_model):
+         # Forward pass, argmax and NaN check compiled together with XLA
+         @tf.function(jit_compile=True)
+         def predict_step(features):
+            logits = loaded_model(features, training=False).logits
+            return tf.argmax(logits, axis=1, output_type=tf.int32), tf.reduce_any(tf.math.is_nan(logits))
+
+         return predict_step
+
+      def get_predictions(predict_step):
+         def predict_batch(features):
+            predictions, has_nan = predict_step(features)
+            if has_nan:
+               raise FloatingPointError(f'NaN logits with {tf.keras.mixed_precision.global_policy().name} policy')
+            return predictions
+
+         return collect_predictions(predict_batch)
+
+      def get_onnx_int8_predictions(loaded_model):
+         import tf2onnx
+         import onnxruntime as ort
+         from onnxruntime.quantization import quantize_dynamic, QuantType
+
+         # Export the forward pass to ONNX and quantize the weights to INT8 (uses VNNI on supporting CPUs)
+         input_signature = [tf.TensorSpec([None, max_sequence_length], tf.int32, name='input_ids')]
+
+         @tf.function(input_signature=input_signature)
+         def serving_fn(input_ids):
+            return {'logits': loaded_model(input_ids, training=False).logits}
+
+         onnx_dir = tempfile.mkdtemp()
+         onnx_path = os.path.join(onnx_dir, f'{model_save_name}.onnx')
+         onnx_int8_path = os.path.join(onnx_dir, f'{model_save_name}.int8.onnx')
+         tf2onnx.convert.from_function(serving_fn, input_signature=input_signature, opset=13, output_path=onnx_path)
+         quantize_dynamic(onnx_path, onnx_int8_path, weight_type=QuantType.QInt8)
+
+         session = ort.InferenceSession(onnx_int8_path, providers=['CPUExecutionProvider'])
+         input_name = session.get_inputs()[0].name
+
+         def predict_batch(features):
+            logits = session.run(None, {input_name: features.numpy()})[0]
+            return np.argmax(logits, axis=1)
+
+         return collect_predictions(predict_batch)
+
+      def get_saved_model_predictions():
+         # Call the fixed-length serving graph exported by the train component instead of rebuilding the Keras model
+         served = tf.saved_model.load(model.path)
+         infer = served.signatures['serve']
+
+         # Reduce the logits on device so only the class ids are copied back to the host
+         @tf.function
+         def predict_step(features):
+            logits = infer(input_ids=features)['logits']
+            return tf.argmax(logits, axis=1, output_type=tf.int32)
+
+         return collect_predictions(predict_step)
+
+      # Keep model construction and inference on the accelerator when the task has one
+      inference_device = '/GPU:0' if gpus else '/CPU:0'
+      max_batch_size = min(1024, num_examples)
+      with tf.device(inference_device):
+         if inference_backend != 'saved_model':
+            loaded_model = load_model()
+         if inference_backend == 'keras':
+            predict_step = build_predict_step(loaded_model)
+            if gpus:
+               batch_size = find_inference_batch_size(predict_step, batch_size, max_batch_size)
+               print(f'Inference batch size: {batch_size}')
+
+      # The input pipeline stays on the CPU
+      test_dataset = build_test_dataset(batch_size)
+
+      with tf.device(inference_device):
+         if inference_backend == 'onnx_int8':
+            y_true, y_pred, confusion = get_onnx_int8_predictions(loaded_model)
+         elif inference_backend == 'saved_model':
+            y_true, y_pred, confusion = get_saved_model_predictions()
+         else:
+            try:
+               y_true, y_pred, confusion = get_predictions(predict_step)
+            except FloatingPointError as e:
+               if precision_policy == 'float32':
+                  raise e
+               # Reduced precision overflowed, fall back to full precision
+               print(e)
+               tf.keras.backend.clear_session()
+               tf.keras.mixed_precision.set_global_policy('float32')
+               loaded_model = load_model()
+               predict_step = build_predict_step(loaded_model)
+               # Full precision needs more memory, shrink the batch until it fits again
+               batch_size = find_inference_batch_size(predict_step, batch_size, batch_size)
+               print(f'Inference batch size: {batch_size}')
+               test_dataset = build_test_dataset(batch_size)
+               y_true, y_pred, confusion = get_predictions(predict_step)
+
+      # Calculate metrics on the integer labels, names are only needed for the matrix axes
+      label_ids = np.arange(len(idx_2_label_map))
+      label_names = [idx_2_label_map[i] for i in label_ids]
 
       classification_metrics = {
-        "matrix": confusion_matrix(y_true_decoded, y_pred_decoded, labels=list(idx_2_label_map.values())).tolist(),
-        "labels": list(idx_2_label_map.values())
+        "matrix": confusion.tolist(),
+        "labels": label_names
         }
 
-      precision = precision_score(y_true, y_pred, average='weighted')
-      recall = recall_score(y_true, y_pred, average='weighted')
-      f1 = f1_score(y_true, y_pred, average='weighted')
-
-      precision_per_label = precision_score(y_true, y_pred, average=None)
-      recall_per_label = recall_score(y_true, y_pred, average=None)
-      f1_per_label = f1_score(y_true, y_pred, average=None)
+      precision, recall, f1, _ = precision_recall_fscore_support(y_true, y_pred, labels=label_ids, average='weighted')
+      precision_per_label, recall_per_label, f1_per_label, _ = precision_recall_fscore_support(
+         y_true, y_pred, labels=label_ids, average=None
+         )
 
       reusable_model.uri = model.uri
 
@@ -213,6 +382,8 @@ def test_huggingface_model_component(
             duration=(datetime.now() - start_time).total_seconds() / 60, is_success=True
             )
 
+      wait_for_slack_messages()
+
       output = namedtuple('Outputs', ['precision', 'recall', 'f1_score'])
       return output(precision, recall, f1)
 
@@ -224,4 +395,5 @@ def test_huggingface_model_component(
             execution_date=start_time.date(), execution_time=start_time.time(), 
             duration=(datetime.now() - start_time).total_seconds() / 60, is_success=True
             )
+      wait_for_slack_messages()
       raise e
\ No newline at end of file
@@ -89,12 +89,13 @@ def train_huggingface_model_component(
   def parse_tfrecord_fn(example_proto, max_sequence_length=max_sequence_length):
     # Define the feature description dictionary
     feature_description = {
-        'feature': tf.io.FixedLenFeature([max_sequence_length], tf.int64),  # Adjust the shape [128] as per your data
+        'feature': tf.io.FixedLenFeature([], tf.string),  # Raw int32 token ids of length max_sequence_length
         'label': tf.io.FixedLenFeature([], tf.int64),
         }
     # Parse the input tf.train.Example proto using the feature description
     parsed_example = tf.io.parse_single_example(example_proto, feature_description)
-    return parsed_example['feature'], parsed_example['label']
+    feature = tf.reshape(tf.io.decode_raw(parsed_example['feature'], tf.int32), [max_sequence_length])
+    return feature, parsed_example['label']
 
   try:
 
@@ -171,8 +172,16 @@ def train_huggingface_model_component(
 
     os.makedirs(model_output.path, exist_ok=True)
 
+    # Fixed-length serving graph for holdout evaluation, next to the default signature used by the endpoint
+    @tf.function(input_signature=[tf.TensorSpec([None, max_sequence_length], tf.int32, name='input_ids')])
+    def serve(input_ids):
+      return {'logits': model(input_ids, training=False).logits}
+
     model.save(os.path.join(model_output.path, f'{model_save_name}.keras'))
-    model.save(os.path.join(model_output.path))
+    model.save(
+      os.path.join(model_output.path),
+      signatures={'serving_default': model.serving, 'serve': serve}
+      )
 
     # Track the end time and calculate duration
     end_time = datetime.now()
@@ -91,7 +91,8 @@ def prepare_data_component(
 
   # Function to serialize each example
   def serialize_example(feature, label):
-    feature = tf.train.Feature(int64_list=tf.train.Int64List(value=feature))
+    # Token ids are stored as raw little-endian int32 bytes, readers decode them with tf.io.decode_raw
+    feature = tf.train.Feature(bytes_list=tf.train.BytesList(value=[feature.numpy().astype('<i4').tobytes()]))
     label = tf.train.Feature(int64_list=tf.train.Int64List(value=[label]))
     feature_dict = {
         'feature': feature,
@@ -36,6 +36,8 @@ def get_training_pipeline(
         pipeline_root=pipeline_root,
     )
     def training_pipeline():
+        inference_backend = training_params.get("inference_backend", "keras")
+
         get_data_component_task = get_data_component(
             project_id=project_params.get("gcp_project_id"),
             location=project_params.get("gcp_project_location"),
@@ -100,10 +102,20 @@ def get_training_pipeline(
                 label_map=label_2_idx_map,
                 label_name=data_params.get("label_column_name"),
                 huggingface_model_name=model_name,
-                batch_size=training_params.get("batch_size"),
+                batch_size=training_params.get("inference_batch_size", training_params.get("batch_size")),
+                inference_backend=inference_backend,
                 slack_url=slack_webhook_url
             )
             test_task.set_display_name(f'Testing: {model_params.get("model_name")}')
+            if inference_backend == 'onnx_int8':
+                # ONNX Runtime INT8 inference only runs on the CPU execution provider
+                test_task.set_cpu_limit('16')
+                test_task.set_memory_limit('32G')
+            else:
+                test_task.set_accelerator_type('NVIDIA_TESLA_T4')
+                test_task.set_accelerator_limit(1)
+                test_task.set_cpu_limit('4')
+                test_task.set_memory_limit('16G')
         
         metric_artifacts = dsl.Collected(test_task.outputs['metrics_artifact'])
         models = dsl.Collected(test_task.outputs['reusable_model'])
@@ -121,7 +133,7 @@ def get_training_pipeline(
             test_data_name='holdout',
             label_map=label_2_idx_map,
             huggingface_model_name=best_model_selection_task.outputs["best_model_name"],
-            batch_size=training_params.get("batch_size"),
+            batch_size=training_params.get("inference_batch_size", training_params.get("batch_size")),
             slack_url=slack_webhook_url
         )
 